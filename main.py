@@ -4,20 +4,45 @@
 С псевдоочередью для разгрузки бесплатного хостинга
 """
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, List
+from pydantic import BaseModel, Field, field_validator
+from typing import Optional, Dict, List, Set, Tuple
+from dataclasses import dataclass, field
 import asyncio
 import uuid
 import os
+import heapq
+import bisect
+import time
+import threading
+import multiprocessing
 import shutil
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial, wraps
+from datetime import datetime
 import yt_dlp
+import yt_dlp.postprocessor
+from yt_dlp.postprocessor import FFmpegMergerPP
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 from pathlib import Path
+from urllib.parse import urlsplit
 
-app = FastAPI()
+
+class OrjsonResponse(JSONResponse):
+    """JSON-ответ через orjson (встроенный ORJSONResponse в FastAPI объявлен устаревшим)"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+# orjson сериализует ответы заметно быстрее стандартного json (статус опрашивается каждую секунду)
+app = FastAPI(default_response_class=OrjsonResponse)
 
 # CORS middleware для работы с фронтендом
 app.add_middleware(
@@ -28,23 +53,148 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(HTTPException)
+async def http_error_handler(request: Request, exc: HTTPException):
+    """Ошибки в прежнем формате API: {"error": ...} вместо {"detail": ...}"""
+    return OrjsonResponse({'error': exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    """Некорректное тело запроса - 400 с текстом первой ошибки, как раньше"""
+    error = exc.errors()[0]
+    message = error.get('ctx', {}).get('error') or error['msg']
+    return OrjsonResponse({'error': str(message)}, status_code=400)
+
+
 # Конфигурация
 DOWNLOAD_DIR = Path("downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
-MAX_QUEUE_SIZE = 5  # Максимальный размер очереди
+MAX_QUEUE_SIZE = 5  # Максимальный размер очереди (у каждого web-воркера своя)
 CLEANUP_AFTER_HOURS = 2  # Очистка файлов через N часов
 MAX_QUALITY = 720  # Максимальное реальное качество (даже если запросили 1080p)
+MAX_CONCURRENT_DOWNLOADS = 2  # Обработчиков этапа загрузки (одновременных загрузок)
+STATUS_CACHE_TTL = 0.2  # Сколько секунд отдавать закешированный ответ /api/status
+STATUS_RATE_LIMIT = 10  # Запросов /api/status в секунду с одного IP
+# Раз в сколько секунд слать комментарий в молчащий поток SSE: роутер платформы
+# закрывает соединения без данных (Heroku - через 55 секунд)
+SSE_PING_INTERVAL = 15
+# На Heroku (задана DYNO) запросы приходят через роутер платформы, который дописывает
+# IP клиента последним элементом X-Forwarded-For; левые элементы задает сам клиент
+BEHIND_ROUTER = 'DYNO' in os.environ
+# Необязательный Redis для общего состояния задач: при нескольких web-воркерах
+# любой из них отвечает на /api/status, /api/events и /api/download по чужим задачам
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client: Optional[aioredis.Redis] = (
+    aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+)
+# Идентификатор этого воркера: записывается владельцем в состояние задачи.
+# Пока воркер жив, он продлевает ключ worker:<id> (WORKER_TTL секунд); задачи
+# без живого владельца (воркер перезапущен) считаются потерянными
+WORKER_ID = uuid.uuid4().hex
+WORKER_TTL = 30
+# Канал Redis, в который другие воркеры отправляют id задачи, чтобы этот воркер ее отменил
+CANCEL_CHANNEL = f"worker:{WORKER_ID}:cancel"
+
+@dataclass(slots=True)
+class Task:
+    """
+    Задача на загрузку. __slots__ вместо dict с ~10 ключами: меньше памяти
+    на задачу, доступ к полю по смещению, а не через хеш-таблицу
+    """
+    task_id: str
+    url: str
+    quality: int
+    status: str = 'queued'
+    progress: int = 0
+    created_at: datetime = field(default_factory=datetime.now)
+    completed_at: Optional[datetime] = None
+    platform: Optional[str] = None
+    file_path: Optional[str] = None
+    error: Optional[str] = None
+    video_info: Optional[dict] = None
+
 
 # Хранилище задач и очереди
-tasks: Dict[str, dict] = {}
-queue: List[str] = []
-processing_task_id: Optional[str] = None
+tasks: Dict[str, Task] = {}
+# Подписчики SSE: task_id -> очереди, в которые publish_status пушит изменения статуса
+subscribers: Dict[str, Set[asyncio.Queue]] = {}
+# Статусы, после которых поток событий закрывается
+FINAL_STATUSES = ('completed', 'error', 'cancelled')
+# Без ограничения размера: отмененные задачи остаются в asyncio.Queue до извлечения,
+# поэтому MAX_QUEUE_SIZE проверяется по живым задачам в enqueue_seq
+dl_queue: asyncio.Queue = asyncio.Queue()
+active_tasks: Set[str] = set()
+# Очереди между этапами конвейера: извлечение -> загрузка -> склейка.
+# По одной задаче на стык, чтобы этап не уходил далеко вперед следующего
+fetch_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+mux_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+# Порядковые номера задач в очереди (task_id -> seq) и монотонные счетчики:
+# позиция в очереди = seq - число извлеченных задач - отмененные задачи перед ней
+enqueue_seq: Dict[str, int] = {}
+enqueued_count = 0
+dequeued_count = 0
+# Отсортированные номера отмененных задач, которые еще лежат в dl_queue
+cancelled_seqs: List[int] = []
+# Блокировки записи задачи в Redis: progress_listener и этапы конвейера публикуют
+# статус одновременно, и без них старый снимок мог лечь поверх более нового
+redis_write_locks: Dict[str, asyncio.Lock] = {}
+# Сроки очистки завершенных задач: куча (expire_monotonic, task_id)
+expiry_heap: List[Tuple[float, str]] = []
+# Кеш готовых ответов /api/status: task_id -> (JSON, момент сборки по time.monotonic)
+status_cache: Dict[str, Tuple[bytes, float]] = {}
+# Счетчики запросов статуса по IP в текущем секундном окне
+rate_window = 0
+rate_counts: Dict[str, int] = {}
+# Процессы пула запускаются через forkserver, а не fork: к моменту пересоздания пула
+# в родителе уже работают потоки executor'а, и fork копировал бы их блокировки
+MP_CONTEXT = multiprocessing.get_context('forkserver')
+# Очередь (task_id, percent) от хуков прогресса yt-dlp в процессах пула.
+# Создается при старте приложения вместе с пулом: процессы пула (forkserver)
+# заново импортируют этот модуль, и собственные очередь и пул им не нужны
+progress_queue: Optional[multiprocessing.Queue] = None
+# Поля info, которые процесс загрузки возвращает обратно (весь info тяжело сериализовать)
+INFO_FIELDS = ('title', 'duration')
+# Самые объемные поля info, не нужные загрузке и склейке: не передаем их между процессами
+INFO_DROP_FIELDS = ('formats', 'thumbnails', 'subtitles', 'automatic_captions', 'heatmap')
+# Служебные ключи info, нужные этапу склейки; остальные ключи '__*' (постпроцессоры
+# с исправлениями и т.п.) ссылаются на YoutubeDL и между процессами не передаются
+MUX_INFO_KEYS = ('__files_to_merge', '__fixups', '__finaldir')
+# Опции, которые меняются от загрузки к загрузке; остальные задаются при создании YoutubeDL
+PER_DOWNLOAD_OPTS = ('format', 'outtmpl')
+# Экземпляры YoutubeDL процесса пула по платформам: разбор опций, реестр экстракторов
+# и пул соединений создаются один раз. yt-dlp не реентерабелен, поэтому доступ под блокировкой
+_ydl_instances: Dict[str, yt_dlp.YoutubeDL] = {}
+_ydl_lock = threading.Lock()
+# Состояние процесса пула для хука прогресса
+_progress_queue: Optional[multiprocessing.Queue] = None
+_current_task_id: Optional[str] = None
+_last_percent: Optional[int] = None
+# Доли форматов текущей задачи в общем прогрессе: format_id -> (начало, доля)
+_format_shares: Dict[str, Tuple[float, float]] = {}
+
+
+class VideoFileResponse(FileResponse):
+    """
+    FileResponse для крупных видео: читает файл блоками по 1 МБ вместо 64 КБ.
+    Если ASGI-сервер поддерживает http.response.pathsend, Starlette отдает файл
+    через sendfile и блоки не используются.
+    """
+    chunk_size = 1024 * 1024
 
 
 class DownloadRequest(BaseModel):
-    url: str
+    # Отсутствующий url проверяется тем же валидатором, что и пустой
+    url: str = Field('', validate_default=True)
     quality: int = 720
 
+    @field_validator('url')
+    @classmethod
+    def url_required(cls, url: str) -> str:
+        if not url:
+            raise ValueError('URL is required')
+        return url
+
 
 class TaskStatus(BaseModel):
     task_id: str
@@ -55,18 +205,33 @@ class TaskStatus(BaseModel):
     video_info: Optional[dict] = None
 
 
+# Платформа определяется по домену (и его поддоменам), а не по подстроке во всем URL
+_PLATFORM_MAP = {
+    'youtube.com': 'youtube',
+    'youtu.be': 'youtube',
+    'vkvideo.ru': 'vk',
+    'vk.com': 'vk',
+    'instagram.com': 'instagram',
+}
+
+
 def detect_platform(url: str) -> str:
     """Определяет платформу по URL"""
-    url_lower = url.lower()
-    
-    if 'youtube.com' in url_lower or 'youtu.be' in url_lower:
-        return 'youtube'
-    elif 'vk.com' in url_lower or 'vkvideo.ru' in url_lower:
-        return 'vk'
-    elif 'instagram.com' in url_lower:
-        return 'instagram'
-    else:
+    # Ссылку без схемы (youtube.com/watch?v=...) разбираем как //host/path.
+    # Схема - буквы и цифры перед первым '://'; '://' дальше в пути или параметрах не в счет
+    scheme, sep, _ = url.partition('://')
+    try:
+        # hostname уже в нижнем регистре и без порта - приводится только имя хоста
+        host = urlsplit(url if sep and scheme.isalnum() else '//' + url).hostname or ''
+    except ValueError:
         return 'unknown'
+    # m.youtube.com -> youtube.com -> com
+    while host:
+        platform = _PLATFORM_MAP.get(host)
+        if platform:
+            return platform
+        host = host.partition('.')[2]
+    return 'unknown'
 
 
 def get_ydl_opts(quality: int, output_path: str, platform: str) -> dict:
@@ -84,6 +249,24 @@ def get_ydl_opts(quality: int, output_path: str, platform: str) -> dict:
         'no_warnings': False,
         'extract_flat': False,
         'nocheckcertificate': True,
+        # Параллельная загрузка фрагментов HLS/DASH (MAX_CONCURRENT_DOWNLOADS * 4 соединений)
+        'concurrent_fragment_downloads': 4,
+        # Загрузка обычных файлов кусками по 10 МБ
+        'http_chunk_size': 10485760,
+        # Не проверяем доступность каждого формата отдельным запросом
+        'check_formats': False,
+        # Прогресс уходит через хук, строка прогресса в логе не нужна
+        'noprogress': True,
+        'no_color': True,
+        'writesubtitles': False,
+        'writethumbnail': False,
+        # watch?v=X&list=... - загружаем видео X, а не плейлист
+        'noplaylist': True,
+        # Ссылка только на плейлист: извлекаем лишь первое видео (см. sync_extract)
+        'lazy_playlist': True,
+        'playlistend': 1,
+        # Ограничиваем худшее время извлечения
+        'extractor_retries': 2,
     }
     
     # Специфичные опции для YouTube (обход защиты от роботов)
@@ -133,96 +316,491 @@ def get_ydl_opts(quality: int, output_path: str, platform: str) -> dict:
     return base_opts
 
 
-async def download_video(task_id: str, url: str, quality: int):
-    """Асинхронная загрузка видео"""
-    global processing_task_id
+def init_download_process(queue: multiprocessing.Queue):
+    """Инициализация процесса пула: запоминает очередь для отправки прогресса"""
+    global _progress_queue
+    _progress_queue = queue
+
+
+# Пул процессов для yt-dlp: расшифровка подписей, JS-интерпретатор и разбор
+# HLS-манифестов упираются в GIL, в отдельных процессах они идут параллельно.
+# По процессу на каждый обработчик конвейера: извлечение, загрузки и склейка
+def create_download_pool() -> ProcessPoolExecutor:
+    """Создает пул процессов для yt-dlp (при старте и после гибели процесса)"""
+    return ProcessPoolExecutor(
+        max_workers=MAX_CONCURRENT_DOWNLOADS + 2,
+        mp_context=MP_CONTEXT,
+        initializer=init_download_process,
+        initargs=(progress_queue,),
+    )
+
+
+DL_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def report_progress(d: dict):
+    """
+    Хук прогресса yt-dlp (выполняется в процессе пула).
+    Отправляет процент загрузки текущей задачи, только когда он изменился
+    """
+    global _last_percent
+    if d['status'] != 'downloading':
+        return
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    if not total:
+        return
+    # Видео и аудио качаются по очереди, у каждого свой total_bytes:
+    # пересчитываем в прогресс всей задачи по доле формата
+    start, share = _format_shares.get(d['info_dict'].get('format_id'), (0.0, 1.0))
+    # 100% выставляется после завершения задачи целиком, включая склейку
+    percent = min(int(100 * (start + share * d['downloaded_bytes'] / total)), 99)
+    if percent != _last_percent:
+        _last_percent = percent
+        _progress_queue.put((_current_task_id, percent))
+
+
+def plain_errors(func):
+    """
+    Декоратор функций, выполняемых в пуле процессов. Исключения yt-dlp
+    (DownloadError и др.) ссылаются на логгер и не сериализуются pickle,
+    поэтому в родительский процесс передается только текст ошибки
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            raise Exception(str(e)) from None
+    return wrapper
+
+
+def format_shares(info: dict) -> Dict[str, Tuple[float, float]]:
+    """
+    Доли выбранных форматов (видео + аудио) в прогрессе задачи пропорционально
+    их размеру; если размер хотя бы одного неизвестен - поровну
+    """
+    formats = info.get('requested_formats') or []
+    sizes = [f.get('filesize') or f.get('filesize_approx') for f in formats]
+    if not all(sizes):
+        sizes = [1] * len(formats)
+    total = sum(sizes)
+    shares, start = {}, 0.0
+    for f, size in zip(formats, sizes):
+        shares[f['format_id']] = (start, size / total)
+        start += size / total
+    return shares
+
+
+class StagedYoutubeDL(yt_dlp.YoutubeDL):
+    """
+    YoutubeDL, у которого склейка видео и аудио вынесена из process_info:
+    файлы форматов остаются на диске, а склейку выполняет отдельный этап конвейера
+    """
+
+    def post_process(self, filename, info, files_to_move=None):
+        if info.get('__files_to_merge'):
+            # Склейку и исправления после нее выполнит этап mux. Постпроцессоры
+            # держат ссылку на YoutubeDL, поэтому запоминаем только классы исправлений
+            info['__fixups'] = [
+                type(pp).__name__ for pp in info.pop('__postprocessors', ())
+                if not isinstance(pp, FFmpegMergerPP)
+            ]
+            info['filepath'] = filename
+            return info
+        return super().post_process(filename, info, files_to_move)
+
+    def merge_formats(self, info: dict) -> dict:
+        """Склеивает загруженные форматы и выполняет отложенные исправления"""
+        info['__postprocessors'] = [FFmpegMergerPP(self)] + [
+            getattr(yt_dlp.postprocessor, name)(self) for name in info.pop('__fixups', ())
+        ]
+        return super().post_process(info['filepath'], info)
+
+
+def get_shared_ydl(platform: str, ydl_opts: dict) -> StagedYoutubeDL:
+    """Общий экземпляр YoutubeDL процесса пула для платформы (вызывать под _ydl_lock)"""
+    ydl = _ydl_instances.get(platform)
+    if ydl is None:
+        ydl = StagedYoutubeDL({
+            **{k: v for k, v in ydl_opts.items() if k not in PER_DOWNLOAD_OPTS},
+            'progress_hooks': [report_progress],
+            # Постобработка не нужна, склейка идет отдельным этапом
+            'postprocessors': [],
+        })
+        _ydl_instances[platform] = ydl
+    return ydl
+
+
+@contextmanager
+def task_opts(ydl: yt_dlp.YoutubeDL, ydl_opts: dict):
+    """
+    Подставляет в общий экземпляр YoutubeDL формат и шаблон имени конкретной
+    задачи; на выходе прежние значения восстанавливаются
+    """
+    saved = ydl.params.get('format'), ydl.format_selector, ydl.params['outtmpl']['default']
+    ydl.params['format'] = ydl_opts['format']
+    ydl.format_selector = ydl.build_format_selector(ydl_opts['format'])
+    ydl.params['outtmpl']['default'] = ydl_opts['outtmpl']
+    try:
+        yield ydl
+    finally:
+        ydl.params['format'], ydl.format_selector, ydl.params['outtmpl']['default'] = saved
+
+
+@plain_errors
+def sync_extract(platform: str, ydl_opts: dict, url: str) -> dict:
+    """
+    Этап 1 (процесс пула): извлекает информацию о видео и выбирает форматы.
+    Объемные поля отбрасываются, чтобы не гонять их между процессами
+    """
+    with _ydl_lock:
+        ydl = get_shared_ydl(platform, ydl_opts)
+        with task_opts(ydl, ydl_opts):
+            info = ydl.extract_info(url, download=False)
+    # Ссылка только на плейлист (без конкретного видео): берем первое видео
+    if info.get('_type') == 'playlist':
+        entries = info.get('entries') or []
+        if not entries:
+            raise Exception("Плейлист пуст")
+        info = entries[0]
+    for key in INFO_DROP_FIELDS:
+        info.pop(key, None)
+    return info
+
+
+@plain_errors
+def sync_fetch(task_id: str, platform: str, ydl_opts: dict, info: dict) -> dict:
+    """Этап 2 (процесс пула): загружает выбранные форматы без склейки"""
+    global _current_task_id, _last_percent, _format_shares
+    
+    with _ydl_lock:
+        ydl = get_shared_ydl(platform, ydl_opts)
+        _current_task_id, _last_percent = task_id, None
+        _format_shares = format_shares(info)
+        # Извлечение шло в другом процессе: cookies, выставленные экстрактором,
+        # есть только в info (как при --load-info-json) - переносим их в свой cookiejar
+        for fmt in (info, *(info.get('requested_formats') or ())):
+            ydl._load_cookies(fmt.get('cookies'), autoscope=False)
+        with task_opts(ydl, ydl_opts):
+            ydl.process_info(info)
+    return {
+        key: value for key, value in info.items()
+        if not key.startswith('__') or key in MUX_INFO_KEYS
+    }
+
+
+@plain_errors
+def sync_mux(
+    platform: str, ydl_opts: dict, info: dict
+) -> Tuple[dict, Optional[str], Optional[int]]:
+    """
+    Этап 3 (процесс пула): склеивает видео и аудио через ffmpeg.
+    Возвращает нужные поля info, путь к итоговому файлу и его размер;
+    все обращения к файловой системе выполняются здесь, а не в цикле событий
+    """
+    if info.get('__files_to_merge'):
+        with _ydl_lock:
+            info = get_shared_ydl(platform, ydl_opts).merge_formats(info)
+    file_path = info.get('filepath')
+    file_size = os.stat(file_path).st_size if file_path else None
+    return {key: info[key] for key in INFO_FIELDS if key in info}, file_path, file_size
+
+
+def queue_position(seq: int) -> int:
+    """Позиция задачи с номером seq без учета отмененных задач перед ней"""
+    return seq - dequeued_count - bisect.bisect_left(cancelled_seqs, seq)
+
+
+def build_task_status(task_id: str, task: Task) -> dict:
+    """Собирает ответ со статусом задачи (для /api/status и SSE)"""
+    response = {
+        'task_id': task_id,
+        'status': task.status,
+        'progress': task.progress
+    }
+    
+    # Добавляем позицию в очереди, если задача в очереди
+    seq = enqueue_seq.get(task_id)
+    if task.status == 'queued' and seq is not None:
+        response['queue_position'] = queue_position(seq)
+    
+    # Добавляем информацию о видео, если загрузка завершена
+    if task.status == 'completed':
+        response['video_info'] = task.video_info or {}
     
+    # Добавляем ошибку, если есть
+    if task.status == 'error':
+        response['error'] = task.error or 'Неизвестная ошибка'
+    
+    return response
+
+
+async def publish_status(task_id: str):
+    """
+    Рассылает текущий статус задачи подписчикам SSE этого воркера
+    и сохраняет его в Redis для остальных
+    """
+    # Статус изменился - закешированный ответ /api/status устарел
+    status_cache.pop(task_id, None)
+    task = tasks.get(task_id)
+    if task is None:
+        return
+    status = build_task_status(task_id, task)
+    for subscriber in subscribers.get(task_id, ()):
+        subscriber.put_nowait(status)
+    if redis_client is not None:
+        async with redis_write_locks.setdefault(task_id, asyncio.Lock()):
+            # Снимок пересобираем под блокировкой: последней в Redis ложится самая
+            # свежая запись. Задачу могли удалить, пока ждали блокировку
+            task = tasks.get(task_id)
+            if task is not None:
+                await save_task_state(task, build_task_status(task_id, task))
+
+
+async def save_task_state(task: Task, status: dict):
+    """
+    Сохраняет задачу в Redis (hash task:<id> со статусом, путем к файлу и снимком ответа)
+    и публикует снимок в канал task:<id>:events для SSE на других воркерах
+    """
+    key = f"task:{task.task_id}"
+    snapshot = orjson.dumps(status)
     try:
-        # Обновляем статус на "processing"
-        tasks[task_id]['status'] = 'processing'
-        tasks[task_id]['progress'] = 10
-        processing_task_id = task_id
-        
-        # Определяем платформу
-        platform = detect_platform(url)
-        if platform == 'unknown':
-            raise Exception("Неподдерживаемая платформа. Поддерживаются: YouTube, VK, Instagram")
-        
-        tasks[task_id]['platform'] = platform
-        tasks[task_id]['progress'] = 20
-        
-        # Создаем уникальную директорию для задачи
-        task_dir = DOWNLOAD_DIR / task_id
-        task_dir.mkdir(exist_ok=True)
-        
-        output_template = str(task_dir / '%(title)s.%(ext)s')
-        
-        # Настраиваем yt-dlp
-        ydl_opts = get_ydl_opts(quality, output_template, platform)
-        
-        tasks[task_id]['progress'] = 30
-        
-        # Извлекаем информацию о видео (асинхронно)
-        loop = asyncio.get_event_loop()
-        
-        def extract_info():
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                return ydl.extract_info(url, download=True)
-        
-        # Запускаем в executor для асинхронности
-        info = await loop.run_in_executor(None, extract_info)
-        
-        tasks[task_id]['progress'] = 90
-        
-        # Сохраняем информацию о видео
-        video_info = {
-            'title': info.get('title', 'Видео'),
-            'duration': format_duration(info.get('duration', 0)),
-            'quality': f"{min(quality, MAX_QUALITY)}p",
-            'size': 'Уточняется',
-        }
-        
-        # Находим скачанный файл
-        files = list(task_dir.glob('*'))
-        if files:
-            video_file = files[0]
-            file_size = video_file.stat().st_size
-            video_info['size'] = format_size(file_size)
-            tasks[task_id]['file_path'] = str(video_file)
-        
-        tasks[task_id]['video_info'] = video_info
-        tasks[task_id]['status'] = 'completed'
-        tasks[task_id]['progress'] = 100
-        tasks[task_id]['completed_at'] = datetime.now()
-        
-    except Exception as e:
-        tasks[task_id]['status'] = 'error'
-        tasks[task_id]['error'] = str(e)
-        print(f"Error downloading video for task {task_id}: {e}")
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={
+                'status': task.status,
+                'file_path': task.file_path or '',
+                'snapshot': snapshot,
+                'owner': WORKER_ID,
+            })
+            # Ключ живет столько же, сколько файлы задачи
+            pipe.expire(key, CLEANUP_AFTER_HOURS * 3600)
+            pipe.publish(f"{key}:events", snapshot)
+            await pipe.execute()
+    except RedisError as e:
+        print(f"Redis error for task {task.task_id}: {e}")
+
+
+async def load_task_state(task_id: str) -> Optional[Dict[str, str]]:
+    """Читает из Redis состояние задачи другого воркера, None если ее нет"""
+    if redis_client is None:
+        return None
+    try:
+        state = await redis_client.hgetall(f"task:{task_id}")
+        if not state:
+            return None
+        # Незавершенная задача воркера, который больше не работает: ее уже никто
+        # не закончит и не отменит - удаляем, сообщив подписчикам об ошибке
+        owner = state.get('owner')
+        if state['status'] not in FINAL_STATUSES and owner and not await redis_client.exists(f"worker:{owner}"):
+            print(f"Owner of task {task_id} is gone, dropping its state")
+            await delete_task_state(task_id, final_event={
+                'task_id': task_id,
+                'status': 'error',
+                'error': 'Загрузка прервана перезапуском сервера. Попробуйте еще раз.',
+            })
+            return None
+        return state
+    except RedisError as e:
+        print(f"Redis error for task {task_id}: {e}")
+        return None
+
+
+async def delete_task_state(task_id: str, final_event: Optional[dict] = None):
+    """Удаляет задачу из Redis, при необходимости отправив подписчикам последнее событие"""
+    if redis_client is None:
+        return
+    key = f"task:{task_id}"
+    # Под той же блокировкой, что и запись: начатое сохранение не вернет удаленный ключ
+    async with redis_write_locks.setdefault(task_id, asyncio.Lock()):
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if final_event is not None:
+                    pipe.publish(f"{key}:events", orjson.dumps(final_event))
+                await pipe.execute()
+        except RedisError as e:
+            print(f"Redis error for task {task_id}: {e}")
+    # Задачи уже нет в tasks, новые записи по ней не начнутся
+    redis_write_locks.pop(task_id, None)
+
+
+async def run_in_pool(func, *args):
+    """
+    Выполняет этап в пуле процессов. Если процесс пула убит (например, OOM),
+    пул непригоден для всех следующих задач: пересоздаем его, а текущая
+    задача завершается ошибкой
+    """
+    global DL_POOL
     
-    finally:
-        processing_task_id = None
-        # Запускаем следующую задачу из очереди
-        await process_next_in_queue()
+    pool = DL_POOL
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Пул пересоздает первый заметивший, остальные задачи того же пула просто падают
+        if DL_POOL is pool:
+            print("Download process died, recreating the pool")
+            DL_POOL = create_download_pool()
+            pool.shutdown(wait=False)
+        raise Exception("Процесс загрузки аварийно завершился. Попробуйте еще раз.") from None
+
+
+async def drop_cancelled(task_id: str):
+    """
+    Убирает следы задачи, отмененной между этапами или во время этапа:
+    yt-dlp мог заново создать ее директорию и записать туда файлы
+    """
+    active_tasks.discard(task_id)
+    await remove_task_dir(DOWNLOAD_DIR / task_id)
+
+
+async def fail_task(task_id: str, error: Exception):
+    """Переводит задачу в статус ошибки (если ее еще не отменили)"""
+    task = tasks.get(task_id)
+    active_tasks.discard(task_id)
+    if task is None:
+        await drop_cancelled(task_id)
+        return
+    task.status = 'error'
+    task.error = str(error)
+    print(f"Error downloading video for task {task_id}: {error}")
+    await publish_status(task_id)
 
 
-async def process_next_in_queue():
-    """Обрабатывает следующую задачу из очереди"""
-    global processing_task_id, queue
+async def extract_video(task_id: str, task: Task) -> tuple:
+    """Готовит задачу и извлекает информацию о видео; возвращает элемент для этапа загрузки"""
+    # Обновляем статус на "processing"
+    task.status = 'processing'
+    task.progress = 0
+    active_tasks.add(task_id)
+    await publish_status(task_id)
     
-    if processing_task_id is None and queue:
-        next_task_id = queue.pop(0)
-        task = tasks.get(next_task_id)
-        
-        if task and task['status'] == 'queued':
-            # Запускаем обработку в фоне
-            asyncio.create_task(
-                download_video(
-                    next_task_id,
-                    task['url'],
-                    task['quality']
-                )
-            )
+    # Определяем платформу
+    platform = detect_platform(task.url)
+    if platform == 'unknown':
+        raise Exception("Неподдерживаемая платформа. Поддерживаются: YouTube, VK, Instagram")
+    
+    task.platform = platform
+    
+    # Создаем уникальную директорию для задачи (вне цикла событий)
+    loop = asyncio.get_event_loop()
+    task_dir = DOWNLOAD_DIR / task_id
+    await loop.run_in_executor(None, partial(task_dir.mkdir, exist_ok=True))
+    
+    output_template = str(task_dir / '%(title)s.%(ext)s')
+    
+    # Настраиваем yt-dlp
+    ydl_opts = get_ydl_opts(task.quality, output_template, platform)
+    
+    # Извлекаем информацию о видео в пуле процессов
+    info = await run_in_pool(sync_extract, platform, ydl_opts, task.url)
+    return task_id, platform, ydl_opts, info
+
+
+async def complete_task(task_id: str, info: dict, file_path: Optional[str], file_size: Optional[int]):
+    """Сохраняет результат загрузки и планирует очистку файлов"""
+    task = tasks.get(task_id)
+    active_tasks.discard(task_id)
+    # Задачу отменили, пока шла склейка
+    if task is None:
+        await drop_cancelled(task_id)
+        return
+    
+    # Сохраняем информацию о видео
+    video_info = {
+        'title': info.get('title', 'Видео'),
+        'duration': format_duration(info.get('duration', 0)),
+        'quality': f"{min(task.quality, MAX_QUALITY)}p",
+        'size': 'Уточняется',
+    }
+    
+    # Путь и размер файла получены в процессе склейки
+    if file_path:
+        video_info['size'] = format_size(file_size)
+        task.file_path = file_path
+    
+    task.video_info = video_info
+    task.status = 'completed'
+    task.progress = 100
+    task.completed_at = datetime.now()
+    # Планируем очистку файлов через CLEANUP_AFTER_HOURS
+    heapq.heappush(expiry_heap, (time.monotonic() + CLEANUP_AFTER_HOURS * 3600, task_id))
+    await publish_status(task_id)
+
+
+async def progress_listener():
+    """
+    Принимает прогресс из процессов пула и обновляет задачи.
+    Блокирующее чтение multiprocessing.Queue выполняется в потоке
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        item = await loop.run_in_executor(None, progress_queue.get)
+        if item is None:
+            break
+        task_id, percent = item
+        task = tasks.get(task_id)
+        # Прогресс мог прийти уже после завершения или отмены задачи
+        if task and task.status == 'processing':
+            task.progress = percent
+            await publish_status(task_id)
+
+
+async def extract_worker():
+    """Этап 1 конвейера: забирает задачи из очереди и извлекает информацию о видео"""
+    global dequeued_count
+    
+    while True:
+        task_id = await dl_queue.get()
+        dequeued_count += 1
+        enqueue_seq.pop(task_id, None)
+        # Извлеченная отмененная задача больше не стоит перед остальными
+        while cancelled_seqs and cancelled_seqs[0] <= dequeued_count:
+            cancelled_seqs.pop(0)
+        # Позиции оставшихся задач сдвинулись - сообщаем подписчикам
+        for queued_id in list(enqueue_seq):
+            await publish_status(queued_id)
+        try:
+            task = tasks.get(task_id)
+            # Отмененные задачи остаются в очереди, просто пропускаем их
+            if task and task.status == 'queued':
+                item = await extract_video(task_id, task)
+                # Ждет, пока этап загрузки освободится
+                await fetch_queue.put(item)
+        except Exception as e:
+            await fail_task(task_id, e)
+        finally:
+            dl_queue.task_done()
+
+
+async def fetch_worker():
+    """Этап 2 конвейера: загружает видео и аудио (параллельно с извлечением следующей задачи)"""
+    while True:
+        task_id, platform, ydl_opts, info = await fetch_queue.get()
+        try:
+            # Задачу могли отменить, пока она ждала этапа
+            if task_id in tasks:
+                info = await run_in_pool(sync_fetch, task_id, platform, ydl_opts, info)
+                await mux_queue.put((task_id, platform, ydl_opts, info))
+            else:
+                await drop_cancelled(task_id)
+        except Exception as e:
+            await fail_task(task_id, e)
+
+
+async def mux_worker():
+    """Этап 3 конвейера: склеивает видео и аудио (параллельно с загрузкой следующей задачи)"""
+    while True:
+        task_id, platform, ydl_opts, info = await mux_queue.get()
+        try:
+            if task_id in tasks:
+                info, file_path, file_size = await run_in_pool(sync_mux, platform, ydl_opts, info)
+                await complete_task(task_id, info, file_path, file_size)
+            else:
+                # В том числе отмененные во время загрузки
+                await drop_cancelled(task_id)
+        except Exception as e:
+            await fail_task(task_id, e)
 
 
 def format_duration(seconds: int) -> str:
@@ -249,41 +827,75 @@ def format_size(bytes_size: int) -> str:
     return f"{bytes_size:.1f} ТБ"
 
 
+async def remove_task_dir(task_dir: Path):
+    """Удаляет директорию задачи в потоке, не блокируя цикл событий"""
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, partial(shutil.rmtree, task_dir, ignore_errors=True))
+
+
 async def cleanup_old_files():
-    """Периодическая очистка старых файлов"""
+    """
+    Очистка старых файлов: спит до ближайшего срока из expiry_heap,
+    без периодического обхода всех задач
+    """
     while True:
         try:
-            current_time = datetime.now()
-            tasks_to_remove = []
+            # Сроков нет - ждем, новые задачи истекают не раньше чем через CLEANUP_AFTER_HOURS
+            if not expiry_heap:
+                await asyncio.sleep(3600)
+                continue
+            
+            delay = expiry_heap[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            _, task_id = heapq.heappop(expiry_heap)
             
-            for task_id, task in tasks.items():
-                if task.get('completed_at'):
-                    age = current_time - task['completed_at']
-                    if age > timedelta(hours=CLEANUP_AFTER_HOURS):
-                        # Удаляем файлы
-                        task_dir = DOWNLOAD_DIR / task_id
-                        if task_dir.exists():
-                            shutil.rmtree(task_dir)
-                        tasks_to_remove.append(task_id)
+            # Отмененные задачи уже удалены (task_id - uuid4 и не переиспользуется)
+            if task_id not in tasks:
+                continue
             
-            # Удаляем задачи из памяти
-            for task_id in tasks_to_remove:
-                del tasks[task_id]
+            # Удаляем файлы
+            task_dir = DOWNLOAD_DIR / task_id
+            await remove_task_dir(task_dir)
             
-            if tasks_to_remove:
-                print(f"Cleaned up {len(tasks_to_remove)} old tasks")
+            # Удаляем задачу из памяти и из Redis
+            del tasks[task_id]
+            status_cache.pop(task_id, None)
+            await delete_task_state(task_id)
+            print(f"Cleaned up task {task_id}")
         
         except Exception as e:
             print(f"Error in cleanup: {e}")
-        
-        # Запускаем каждый час
-        await asyncio.sleep(3600)
 
 
 @app.on_event("startup")
 async def startup_event():
     """Запуск фоновых задач при старте приложения"""
+    global progress_queue, DL_POOL
+    
+    progress_queue = MP_CONTEXT.Queue()
+    DL_POOL = create_download_pool()
     asyncio.create_task(cleanup_old_files())
+    asyncio.create_task(progress_listener())
+    # Конвейер загрузки: самый долгий этап (загрузка) обслуживают несколько обработчиков
+    asyncio.create_task(extract_worker())
+    for _ in range(MAX_CONCURRENT_DOWNLOADS):
+        asyncio.create_task(fetch_worker())
+    asyncio.create_task(mux_worker())
+    if redis_client is not None:
+        asyncio.create_task(worker_heartbeat())
+        asyncio.create_task(cancel_listener())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка пула загрузок при завершении приложения"""
+    DL_POOL.shutdown(wait=True)
+    progress_queue.put(None)
+    if redis_client is not None:
+        await redis_client.aclose()
 
 
 @app.get("/")
@@ -295,6 +907,7 @@ async def root():
         "endpoints": {
             "download": "/api/download",
             "status": "/api/status/{task_id}",
+            "events": "/api/events/{task_id}",
             "download_file": "/api/download/{task_id}"
         }
     }
@@ -305,8 +918,10 @@ async def create_download_task(request: DownloadRequest):
     """
     Создает задачу на загрузку видео
     """
-    # Проверяем размер очереди
-    if len(queue) >= MAX_QUEUE_SIZE:
+    global enqueued_count
+    
+    # Проверяем размер очереди (без отмененных задач)
+    if len(enqueue_seq) >= MAX_QUEUE_SIZE:
         raise HTTPException(
             status_code=429,
             detail="Очередь заполнена. Пожалуйста, попробуйте позже."
@@ -316,62 +931,159 @@ async def create_download_task(request: DownloadRequest):
     task_id = str(uuid.uuid4())
     
     # Создаем задачу
-    task = {
-        'task_id': task_id,
-        'url': request.url,
-        'quality': request.quality,
-        'status': 'queued',
-        'created_at': datetime.now(),
-        'progress': 0
-    }
+    task = Task(task_id=task_id, url=request.url, quality=request.quality)
     
+    enqueued_count += 1
+    enqueue_seq[task_id] = enqueued_count
     tasks[task_id] = task
     
-    # Добавляем в очередь
-    queue.append(task_id)
-    queue_position = len(queue)
-    
-    # Если нет активной обработки, запускаем
-    if processing_task_id is None:
-        await process_next_in_queue()
+    # Добавляем в очередь, свободный обработчик заберет задачу сам
+    await dl_queue.put(task_id)
+    position = queue_position(enqueued_count)
+    await publish_status(task_id)
     
     return {
         'task_id': task_id,
         'status': 'queued',
-        'queue_position': queue_position,
+        'queue_position': position,
         'message': 'Задача добавлена в очередь'
     }
 
 
+def request_client_ip(request: Request) -> str:
+    """
+    IP клиента для ограничения частоты. За роутером берем крайний правый адрес
+    X-Forwarded-For (его добавил роутер), а не левый, который можно подделать
+    """
+    forwarded = request.headers.get('x-forwarded-for')
+    if BEHIND_ROUTER and forwarded:
+        return forwarded.rpartition(',')[2].strip()
+    return request.client.host if request.client else 'unknown'
+
+
+def status_rate_limited(client_ip: str) -> bool:
+    """
+    Ограничение частоты опроса статуса по IP (фиксированное окно в 1 секунду).
+    Счетчики сбрасываются целиком при смене окна, так что не копятся
+    """
+    global rate_window
+    
+    now = time.monotonic()
+    window = int(now)
+    if window != rate_window:
+        rate_window = window
+        rate_counts.clear()
+        # Заодно выбрасываем устаревшие ответы: по задачам других воркеров
+        # (прочитанным из Redis) кеш не сбрасывает никто
+        for key in [key for key, (_, built) in status_cache.items() if now - built >= STATUS_CACHE_TTL]:
+            del status_cache[key]
+    rate_counts[client_ip] = rate_counts.get(client_ip, 0) + 1
+    return rate_counts[client_ip] > STATUS_RATE_LIMIT
+
+
 @app.get("/api/status/{task_id}")
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, request: Request):
     """
-    Получает статус задачи
+    Получает статус задачи.
+    Частые опросы одной задачи в пределах STATUS_CACHE_TTL получают уже собранный ответ
     """
-    task = tasks.get(task_id)
+    if status_rate_limited(request_client_ip(request)):
+        raise HTTPException(status_code=429, detail="Слишком много запросов. Попробуйте позже.")
     
-    if not task:
-        raise HTTPException(status_code=404, detail="Задача не найдена")
+    now = time.monotonic()
+    cached = status_cache.get(task_id)
+    if cached is not None and now - cached[1] < STATUS_CACHE_TTL:
+        return Response(content=cached[0], media_type='application/json')
     
-    response = {
-        'task_id': task_id,
-        'status': task['status'],
-        'progress': task.get('progress', 0)
-    }
+    task = tasks.get(task_id)
     
-    # Добавляем позицию в очереди, если задача в очереди
-    if task['status'] == 'queued' and task_id in queue:
-        response['queue_position'] = queue.index(task_id) + 1
+    if task:
+        body = orjson.dumps(build_task_status(task_id, task))
+    else:
+        # Задача может обрабатываться другим воркером; его изменения кеш
+        # не сбрасывают, поэтому ответ устаревает не больше чем на STATUS_CACHE_TTL
+        state = await load_task_state(task_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        body = state['snapshot'].encode()
     
-    # Добавляем информацию о видео, если загрузка завершена
-    if task['status'] == 'completed':
-        response['video_info'] = task.get('video_info', {})
+    status_cache[task_id] = (body, now)
+    return Response(content=body, media_type='application/json')
+
+
+async def local_event_stream(task_id: str, task: Task):
+    """События задачи этого воркера: publish_status пушит статус в asyncio.Queue подписчика"""
+    subscriber: asyncio.Queue = asyncio.Queue()
+    subscribers.setdefault(task_id, set()).add(subscriber)
+    try:
+        status = build_task_status(task_id, task)
+        while True:
+            yield b"data: " + orjson.dumps(status) + b"\n\n"
+            if status['status'] in FINAL_STATUSES:
+                break
+            # В очереди, при извлечении и склейке статус долго не меняется
+            while True:
+                try:
+                    status = await asyncio.wait_for(subscriber.get(), SSE_PING_INTERVAL)
+                    break
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+    finally:
+        task_subscribers = subscribers.get(task_id)
+        if task_subscribers is not None:
+            task_subscribers.discard(subscriber)
+            if not task_subscribers:
+                del subscribers[task_id]
+
+
+async def remote_event_stream(task_id: str):
+    """События задачи другого воркера: снимок из Redis, затем обновления через pub/sub"""
+    key = f"task:{task_id}"
+    pubsub = redis_client.pubsub()
+    await pubsub.subscribe(f"{key}:events")
+    try:
+        # Снимок читаем уже после подписки, чтобы не потерять обновления между ними
+        snapshot = await redis_client.hget(key, 'snapshot')
+        if snapshot is None:
+            return
+        yield b"data: " + snapshot.encode() + b"\n\n"
+        if orjson.loads(snapshot)['status'] in FINAL_STATUSES:
+            return
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=SSE_PING_INTERVAL
+            )
+            if message is None:
+                yield b": ping\n\n"
+                continue
+            yield b"data: " + message['data'].encode() + b"\n\n"
+            if orjson.loads(message['data'])['status'] in FINAL_STATUSES:
+                break
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+@app.get("/api/events/{task_id}")
+async def task_events(task_id: str):
+    """
+    Поток изменений статуса задачи (Server-Sent Events).
+    Одно долгое соединение вместо опроса /api/status каждую секунду
+    """
+    task = tasks.get(task_id)
     
-    # Добавляем ошибку, если есть
-    if task['status'] == 'error':
-        response['error'] = task.get('error', 'Неизвестная ошибка')
+    if task:
+        event_stream = local_event_stream(task_id, task)
+    elif await load_task_state(task_id) is not None:
+        event_stream = remote_event_stream(task_id)
+    else:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
     
-    return response
+    return StreamingResponse(
+        event_stream,
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
 
 
 @app.get("/api/download/{task_id}")
@@ -381,25 +1093,35 @@ async def download_file(task_id: str):
     """
     task = tasks.get(task_id)
     
-    if not task:
-        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if task:
+        status, file_path = task.status, task.file_path
+    else:
+        # Директория загрузок общая для воркеров хоста, состояние чужой задачи - из Redis
+        state = await load_task_state(task_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        status, file_path = state['status'], state['file_path']
     
-    if task['status'] != 'completed':
+    if status != 'completed':
         raise HTTPException(
             status_code=400,
-            detail=f"Видео еще не готово. Статус: {task['status']}"
+            detail=f"Видео еще не готово. Статус: {status}"
         )
     
-    file_path = task.get('file_path')
-    if not file_path or not os.path.exists(file_path):
+    try:
+        stat_result = os.stat(file_path) if file_path else None
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None:
         raise HTTPException(status_code=404, detail="Файл не найден")
     
-    # Возвращаем файл
+    # Возвращаем файл: Content-Type определяется по расширению (video/mp4 и т.д.),
+    # Content-Length берется из уже полученного stat
     filename = os.path.basename(file_path)
-    return FileResponse(
+    return VideoFileResponse(
         path=file_path,
         filename=filename,
-        media_type='application/octet-stream'
+        stat_result=stat_result
     )
 
 
@@ -409,35 +1131,89 @@ async def get_queue_status():
     Получает информацию о текущей очереди (для отладки)
     """
     return {
-        'queue_size': len(queue),
+        'queue_size': len(enqueue_seq),
         'max_queue_size': MAX_QUEUE_SIZE,
-        'processing_task': processing_task_id,
+        'processing_tasks': list(active_tasks),
         'total_tasks': len(tasks),
-        'queue': queue
+        'queue': list(enqueue_seq)
     }
 
 
+async def cancel_local_task(task_id: str):
+    """Отменяет задачу этого воркера"""
+    # Удаляем задачу сразу: повторная отмена, пока удаляются файлы, ничего не сделает
+    if tasks.pop(task_id, None) is None:
+        return
+    
+    # Из asyncio.Queue элемент не удалить: снимаем номер в очереди,
+    # а обработчик пропустит задачу, так как ее уже не будет в tasks
+    seq = enqueue_seq.pop(task_id, None)
+    if seq is not None:
+        bisect.insort(cancelled_seqs, seq)
+        # Задачи за отмененной продвинулись - сообщаем подписчикам
+        for queued_id in list(enqueue_seq):
+            await publish_status(queued_id)
+    
+    # Удаляем файлы если есть
+    task_dir = DOWNLOAD_DIR / task_id
+    await remove_task_dir(task_dir)
+    
+    # Закрываем потоки событий подписчиков (в том числе на других воркерах)
+    status_cache.pop(task_id, None)
+    cancelled_event = {'task_id': task_id, 'status': 'cancelled'}
+    for subscriber in subscribers.get(task_id, ()):
+        subscriber.put_nowait(cancelled_event)
+    await delete_task_state(task_id, final_event=cancelled_event)
+
+
+async def worker_heartbeat():
+    """Продлевает ключ worker:<id>, по которому другие воркеры видят, что владелец задач жив"""
+    while True:
+        try:
+            await redis_client.set(f"worker:{WORKER_ID}", 1, ex=WORKER_TTL)
+        except RedisError as e:
+            print(f"Redis error in heartbeat: {e}")
+        await asyncio.sleep(WORKER_TTL / 3)
+
+
+async def cancel_listener():
+    """Принимает из Redis запросы на отмену задач этого воркера, пришедшие на другие воркеры"""
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CANCEL_CHANNEL)
+            async for message in pubsub.listen():
+                if message['type'] == 'message' and message['data'] in tasks:
+                    await cancel_local_task(message['data'])
+        except RedisError as e:
+            print(f"Redis error in cancel listener: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
 @app.delete("/api/task/{task_id}")
 async def cancel_task(task_id: str):
     """
     Отменяет задачу
     """
-    task = tasks.get(task_id)
+    if task_id in tasks:
+        await cancel_local_task(task_id)
+        return {'message': 'Задача отменена'}
     
-    if not task:
+    # Задача другого воркера: просим владельца отменить ее через его канал в Redis
+    # (задачи без живого владельца load_task_state уже удалил)
+    state = await load_task_state(task_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="Задача не найдена")
-    
-    # Удаляем из очереди если там есть
-    if task_id in queue:
-        queue.remove(task_id)
-    
-    # Удаляем файлы если есть
-    task_dir = DOWNLOAD_DIR / task_id
-    if task_dir.exists():
-        shutil.rmtree(task_dir)
-    
-    # Удаляем задачу
-    del tasks[task_id]
+    try:
+        received = await redis_client.publish(f"worker:{state.get('owner')}:cancel", task_id)
+    except RedisError as e:
+        print(f"Redis error for task {task_id}: {e}")
+        received = 0
+    # Запрос никто не получил - владелец недоступен (например, переподключается к Redis)
+    if not received:
+        raise HTTPException(status_code=503, detail="Не удалось отменить задачу. Попробуйте позже.")
     
     return {'message': 'Задача отменена'}
 
@@ -449,8 +1225,10 @@ if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
-        port=8000,
+        port=int(os.environ.get('PORT', 8000)),
         reload=True,
-        log_level="info"
+        log_level="info",
+        loop="uvloop",
+        http="httptools"
     )
 